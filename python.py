@@ -1,7 +1,14 @@
+import collections
+import io
+import re
+
 import streamlit as st
 import pandas as pd
+import numpy as np
 from google import genai
+from google.genai import types
 from google.genai.errors import APIError
+from python_calamine import CalamineError
 
 # --- Cấu hình Trang Streamlit ---
 st.set_page_config(
@@ -11,71 +18,160 @@ st.set_page_config(
 
 st.title("Ứng dụng Phân Tích Báo Cáo Tài chính 📊")
 
+# --- Các chỉ tiêu chính cần tra cứu trong Bảng cân đối kế toán ---
+KEY_LABELS = ('TÀI SẢN NGẮN HẠN', 'NỢ NGẮN HẠN', 'TỔNG CỘNG TÀI SẢN')
+KEY_LABELS_PATTERN = re.compile('(' + '|'.join(map(re.escape, KEY_LABELS)) + ')')
+
+def build_label_masks(chi_tieu):
+    """Trả về dict {chỉ tiêu: mask} cho các KEY_LABELS, chỉ so khớp trên các giá trị duy nhất."""
+    chi_tieu = chi_tieu.astype('category')
+    labels = chi_tieu.cat.categories.astype(str).str.upper().str.strip()
+    # Một lần quét regex (alternation) xác định chỉ tiêu chính của từng giá trị duy nhất;
+    # phần tử None cuối cùng dành cho code -1 (ô trống)
+    category_keys = np.append(labels.str.extract(KEY_LABELS_PATTERN, expand=False).to_numpy(), None)
+    row_keys = category_keys[chi_tieu.cat.codes.to_numpy()]
+    return {k: pd.Series(row_keys == k, index=chi_tieu.index) for k in KEY_LABELS}
+
 # --- Hàm tính toán chính (Sử dụng Caching để Tối ưu hiệu suất) ---
 @st.cache_data
 def process_financial_data(df):
-    """Thực hiện các phép tính Tăng trưởng và Tỷ trọng."""
+    """Thực hiện các phép tính Tăng trưởng và Tỷ trọng; trả về (DataFrame, vị trí các chỉ tiêu chính)."""
     
-    # Đảm bảo các giá trị là số để tính toán
+    # Đảm bảo các giá trị là số để tính toán, NaN -> 0 ngay trên mảng NumPy
+    # (cột 0 = Năm trước, cột 1 = Năm sau)
     numeric_cols = ['Năm trước', 'Năm sau']
-    for col in numeric_cols:
-        df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
-    
-    # 1. Tính Tốc độ Tăng trưởng
-    # Dùng .replace(0, 1e-9) cho Series Pandas để tránh lỗi chia cho 0
-    df['Tốc độ tăng trưởng (%)'] = (
-        (df['Năm sau'] - df['Năm trước']) / df['Năm trước'].replace(0, 1e-9)
-    ) * 100
+    arr = df[numeric_cols].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=np.float64)
+    arr = np.where(np.isnan(arr), 0.0, arr)
+    prev, curr = arr[:, 0], arr[:, 1]
 
-    # 2. Tính Tỷ trọng theo Tổng Tài sản
-    # Lọc chỉ tiêu "TỔNG CỘNG TÀI SẢN"
-    tong_tai_san_row = df[df['Chỉ tiêu'].str.contains('TỔNG CỘNG TÀI SẢN', case=False, na=False)]
+    # Vị trí dòng đầu tiên của từng chỉ tiêu chính (chỉ tiêu không có trong file thì bỏ qua)
+    masks = build_label_masks(df['Chỉ tiêu'])
+    key_rows = {k: int(mask.to_numpy().argmax()) for k, mask in masks.items() if mask.any()}
     
-    if tong_tai_san_row.empty:
+    # Lọc chỉ tiêu "TỔNG CỘNG TÀI SẢN"
+    if 'TỔNG CỘNG TÀI SẢN' not in key_rows:
         raise ValueError("Không tìm thấy chỉ tiêu 'TỔNG CỘNG TÀI SẢN'.")
 
-    tong_tai_san_N_1 = tong_tai_san_row['Năm trước'].iloc[0]
-    tong_tai_san_N = tong_tai_san_row['Năm sau'].iloc[0]
+    # 1. Tính Tốc độ Tăng trưởng (mẫu số 0 -> tăng trưởng 0)
+    growth = np.divide(curr - prev, prev, out=np.zeros_like(prev), where=prev != 0) * 100.0
 
-    # ******************************* PHẦN SỬA LỖI BẮT ĐẦU *******************************
-    # Xử lý mẫu số 0 thủ công để tính tỷ trọng
-    divisor_N_1 = tong_tai_san_N_1 if tong_tai_san_N_1 != 0 else 1e-9
-    divisor_N = tong_tai_san_N if tong_tai_san_N != 0 else 1e-9
+    # 2. Tính Tỷ trọng theo Tổng Tài sản (mẫu số 0 -> tỷ trọng 0)
+    divisors = arr[key_rows['TỔNG CỘNG TÀI SẢN']]
+    ratios = np.divide(arr, divisors, out=np.zeros_like(arr), where=divisors != 0) * 100.0
 
-    # Tính tỷ trọng với mẫu số đã được xử lý
-    df['Tỷ trọng Năm trước (%)'] = (df['Năm trước'] / divisor_N_1) * 100
-    df['Tỷ trọng Năm sau (%)'] = (df['Năm sau'] / divisor_N) * 100
-    # ******************************* PHẦN SỬA LỖI KẾT THÚC *******************************
-    
-    return df
+    # Dùng assign để trả về DataFrame mới, không thay đổi DataFrame đầu vào
+    return df.assign(**{
+        'Năm trước': prev,
+        'Năm sau': curr,
+        'Tốc độ tăng trưởng (%)': growth,
+        'Tỷ trọng Năm trước (%)': ratios[:, 0],
+        'Tỷ trọng Năm sau (%)': ratios[:, 1]
+    }), key_rows
+
+@st.cache_data(show_spinner=False)
+def load_excel(file_bytes):
+    """Đọc file Excel từ bytes (cache theo nội dung file, không parse lại mỗi lần rerun)."""
+    # Engine calamine (Rust) nhanh hơn openpyxl; chỉ đọc 3 cột cần dùng
+    df = pd.read_excel(
+        io.BytesIO(file_bytes),
+        engine='calamine',
+        usecols=[0, 1, 2],
+        header=0,
+        names=['Chỉ tiêu', 'Năm trước', 'Năm sau']
+    )
+    if df.shape[1] < 3:
+        raise ValueError("File cần có đủ 3 cột: Chỉ tiêu | Năm trước | Năm sau.")
+    # Chỉ tiêu dạng category: tra cứu nhãn chỉ quét các giá trị duy nhất
+    return df.astype({'Chỉ tiêu': 'category'})
+
+@st.cache_data(show_spinner=False)
+def build_ai_payload(file_bytes, tt_n_1, tt_n, tsnh_growth):
+    """Dựng chuỗi markdown gửi cho AI (cache theo file upload và các chỉ số)."""
+    df_processed, _ = process_financial_data(load_excel(file_bytes))
+    tsnh_growth_display = f"{tsnh_growth:.2f}%" if tsnh_growth is not None else "N/A"
+    # Phần tóm tắt chỉ có vài dòng: dựng trực tiếp bằng f-string, không cần to_markdown
+    return (
+        f"- Toàn bộ Bảng phân tích (dữ liệu thô):\n{df_processed.to_markdown(index=False)}\n"
+        f"- Tăng trưởng Tài sản ngắn hạn (%): {tsnh_growth_display}\n"
+        f"- Thanh toán hiện hành (N-1): {tt_n_1}\n"
+        f"- Thanh toán hiện hành (N): {tt_n}\n"
+    )
+
+# --- Cấu hình Gemini (model và prompt dùng chung) ---
+CHAT_MODEL_NAME = "gemini-2.5-flash"
+
+# Giới hạn lịch sử: số tin nhắn hiển thị trong Chatbot và số lượt hỏi-đáp gửi lại cho Gemini
+CHAT_DISPLAY_MAX_MESSAGES = 40
+CHAT_CONTEXT_MAX_TURNS = 10
+
+CHAT_SYSTEM_INSTRUCTION = "Bạn là một trợ lý phân tích tài chính thân thiện và chuyên nghiệp. Bạn có thể trả lời các câu hỏi về đầu tư, thị trường, và các chỉ số tài chính. Hãy trả lời một cách rõ ràng, ngắn gọn và sử dụng tiếng Việt."
+
+PROMPT_TEMPLATE = """
+Bạn là một chuyên gia phân tích tài chính chuyên nghiệp. Dựa trên các chỉ số tài chính sau, hãy đưa ra một nhận xét khách quan, ngắn gọn (khoảng 3-4 đoạn) về tình hình tài chính của doanh nghiệp. Đánh giá tập trung vào tốc độ tăng trưởng, thay đổi cơ cấu tài sản và khả năng thanh toán hiện hành.
+
+Dữ liệu thô và chỉ số:<br>
+{data}
+"""
 
 # --- Hàm gọi API Gemini (Dùng cho phân tích Báo cáo tài chính) ---
+@st.cache_resource(show_spinner=False)
+def get_gemini_client(api_key):
+    """Khởi tạo Gemini Client một lần và dùng lại (kết nối HTTP) cho mọi rerun và phiên."""
+    return genai.Client(api_key=api_key)
+
+def get_chat_session(api_key):
+    """Lấy Chat Session của Chatbot cho phiên hiện tại (tạo 1 lần)."""
+    if "chat_session" not in st.session_state:
+        # Thiết lập persona cho Chat Session để duy trì phong cách trả lời
+        st.session_state.chat_session = get_gemini_client(api_key).chats.create(
+            model=CHAT_MODEL_NAME, 
+            config=types.GenerateContentConfig(system_instruction=CHAT_SYSTEM_INSTRUCTION)
+        )
+        # Tin nhắn chào mừng ban đầu (deque giới hạn số tin nhắn lưu và hiển thị)
+        st.session_state.messages = collections.deque(
+            [{"role": "assistant", "content": "Xin chào! Tôi là trợ lý phân tích tài chính của bạn. Hãy hỏi tôi về các chỉ số, thị trường, hoặc chiến lược đầu tư!"}],
+            maxlen=CHAT_DISPLAY_MAX_MESSAGES
+        )
+    else:
+        # Lịch sử quá dài: tạo Chat Session mới chỉ giữ CHAT_CONTEXT_MAX_TURNS lượt gần nhất
+        # Đếm lượt theo tin nhắn "user": phản hồi stream được lưu thành nhiều Content "model"
+        history = st.session_state.chat_session.get_history(curated=True)
+        user_turns = [i for i, content in enumerate(history) if content.role == "user"]
+        if len(user_turns) > CHAT_CONTEXT_MAX_TURNS:
+            st.session_state.chat_session = get_gemini_client(api_key).chats.create(
+                model=CHAT_MODEL_NAME, 
+                config=types.GenerateContentConfig(system_instruction=CHAT_SYSTEM_INSTRUCTION),
+                history=history[user_turns[-CHAT_CONTEXT_MAX_TURNS]:]
+            )
+    return st.session_state.chat_session
+
 def get_ai_analysis(data_for_ai, api_key):
-    """Gửi dữ liệu phân tích đến Gemini API và nhận nhận xét."""
+    """Gửi dữ liệu phân tích đến Gemini API, stream nhận xét và lưu kết quả vào ai_analysis_cache."""
     try:
-        client = genai.Client(api_key=api_key)
-        model_name = 'gemini-2.5-flash' 
+        # Gọi riêng (không qua Chat Session) để bảng dữ liệu không bị gửi lại ở mọi lượt chat
+        client = get_gemini_client(api_key)
 
-        prompt = f"""
-        Bạn là một chuyên gia phân tích tài chính chuyên nghiệp. Dựa trên các chỉ số tài chính sau, hãy đưa ra một nhận xét khách quan, ngắn gọn (khoảng 3-4 đoạn) về tình hình tài chính của doanh nghiệp. Đánh giá tập trung vào tốc độ tăng trưởng, thay đổi cơ cấu tài sản và khả năng thanh toán hiện hành.
-        
-        Dữ liệu thô và chỉ số:<br>
-        {data_for_ai}
-        """
+        prompt = PROMPT_TEMPLATE.format(data=data_for_ai)
 
-        response = client.models.generate_content(
-            model=model_name,
+        # Stream kết quả để UI hiển thị ngay từ đoạn đầu tiên
+        parts = []
+        for chunk in client.models.generate_content_stream(
+            model=CHAT_MODEL_NAME,
             contents=prompt
-        )
-        return response.text
+        ):
+            if chunk.text:
+                parts.append(chunk.text)
+                yield chunk.text
+
+        st.session_state.setdefault("ai_analysis_cache", {})[data_for_ai] = "".join(parts)
 
     except APIError as e:
-        return f"Lỗi gọi Gemini API: Vui lòng kiểm tra Khóa API hoặc giới hạn sử dụng. Chi tiết lỗi: {e}"
+        yield f"Lỗi gọi Gemini API: Vui lòng kiểm tra Khóa API hoặc giới hạn sử dụng. Chi tiết lỗi: {e}"
     except KeyError:
         # Lỗi này đã được xử lý ở phần dưới khi gọi API
-        return "Lỗi: Không tìm thấy Khóa API 'GEMINI_API_KEY'."
+        yield "Lỗi: Không tìm thấy Khóa API 'GEMINI_API_KEY'."
     except Exception as e:
-        return f"Đã xảy ra lỗi không xác định: {e}"
+        yield f"Đã xảy ra lỗi không xác định: {e}"
 
 
 # --- Chức năng 1: Tải File ---
@@ -85,97 +181,98 @@ uploaded_file = st.file_uploader(
 )
 
 if uploaded_file is not None:
+    file_bytes = uploaded_file.getvalue()
+    df_processed = None
+
+    # Chỉ bắt lỗi quanh bước đọc file (cache theo bytes của file upload)
     try:
-        df_raw = pd.read_excel(uploaded_file)
-        
-        # Tiền xử lý: Đảm bảo chỉ có 3 cột quan trọng
-        df_raw.columns = ['Chỉ tiêu', 'Năm trước', 'Năm sau']
-        
+        df_raw = load_excel(file_bytes)
+    except (ValueError, OSError, CalamineError) as e:
+        st.error(f"Có lỗi xảy ra khi đọc file: {e}. Vui lòng kiểm tra định dạng file.")
+    else:
         # Xử lý dữ liệu
-        df_processed = process_financial_data(df_raw.copy())
+        try:
+            df_processed, key_rows = process_financial_data(df_raw)
+        except ValueError as ve:
+            st.error(f"Lỗi cấu trúc dữ liệu: {ve}")
 
-        if df_processed is not None:
-            
-            # --- Chức năng 2 & 3: Hiển thị Kết quả ---
-            st.subheader("2. Tốc độ Tăng trưởng & 3. Tỷ trọng Cơ cấu Tài sản")
-            st.dataframe(df_processed.style.format({
-                'Năm trước': '{:,.0f}',
-                'Năm sau': '{:,.0f}',
-                'Tốc độ tăng trưởng (%)': '{:.2f}%',
-                'Tỷ trọng Năm trước (%)': '{:.2f}%',
-                'Tỷ trọng Năm sau (%)': '{:.2f}%'
-            }), use_container_width=True)
-            
-            # --- Chức năng 4: Tính Chỉ số Tài chính ---
-            st.subheader("4. Các Chỉ số Tài chính Cơ bản")
+    if df_processed is not None:
+        
+        # --- Chức năng 2 & 3: Hiển thị Kết quả ---
+        st.subheader("2. Tốc độ Tăng trưởng & 3. Tỷ trọng Cơ cấu Tài sản")
+        # Định dạng số bằng column_config (trình duyệt tự render, không dựng Styler mỗi lần rerun)
+        st.dataframe(df_processed, column_config={
+            'Năm trước': st.column_config.NumberColumn(format='localized'),
+            'Năm sau': st.column_config.NumberColumn(format='localized'),
+            'Tốc độ tăng trưởng (%)': st.column_config.NumberColumn(format='%.2f%%'),
+            'Tỷ trọng Năm trước (%)': st.column_config.NumberColumn(format='%.2f%%'),
+            'Tỷ trọng Năm sau (%)': st.column_config.NumberColumn(format='%.2f%%')
+        }, use_container_width=True)
+        
+        # --- Chức năng 4: Tính Chỉ số Tài chính ---
+        st.subheader("4. Các Chỉ số Tài chính Cơ bản")
+        
+        try:
+            # Lọc giá trị cho Chỉ số Thanh toán Hiện hành (Ví dụ)
             
-            try:
-                # Lọc giá trị cho Chỉ số Thanh toán Hiện hành (Ví dụ)
-                
-                # Lấy Tài sản ngắn hạn
-                tsnh_n = df_processed[df_processed['Chỉ tiêu'].str.contains('TÀI SẢN NGẮN HẠN', case=False, na=False)]['Năm sau'].iloc[0]
-                tsnh_n_1 = df_processed[df_processed['Chỉ tiêu'].str.contains('TÀI SẢN NGẮN HẠN', case=False, na=False)]['Năm trước'].iloc[0]
+            # Dùng lại vị trí các chỉ tiêu chính đã tìm trong process_financial_data (đã cache)
+            tsnh_row = df_processed.iloc[key_rows['TÀI SẢN NGẮN HẠN']]
+            no_ngan_han_row = df_processed.iloc[key_rows['NỢ NGẮN HẠN']]
 
-                # Lấy Nợ ngắn hạn
-                no_ngan_han_N = df_processed[df_processed['Chỉ tiêu'].str.contains('NỢ NGẮN HẠN', case=False, na=False)]['Năm sau'].iloc[0]  
-                no_ngan_han_N_1 = df_processed[df_processed['Chỉ tiêu'].str.contains('NỢ NGẮN HẠN', case=False, na=False)]['Năm trước'].iloc[0]
+            # Lấy Tài sản ngắn hạn
+            tsnh_n = tsnh_row['Năm sau']
+            tsnh_n_1 = tsnh_row['Năm trước']
 
-                # Tính toán
-                thanh_toan_hien_hanh_N = tsnh_n / no_ngan_han_N
-                thanh_toan_hien_hanh_N_1 = tsnh_n_1 / no_ngan_han_N_1
-                
-                col1, col2 = st.columns(2)
-                with col1:
-                    st.metric(
-                        label="Chỉ số Thanh toán Hiện hành (Năm trước)",
-                        value=f"{thanh_toan_hien_hanh_N_1:.2f} lần"
-                    )
-                with col2:
-                    st.metric(
-                        label="Chỉ số Thanh toán Hiện hành (Năm sau)",
-                        value=f"{thanh_toan_hien_hanh_N:.2f} lần",
-                        delta=f"{thanh_toan_hien_hanh_N - thanh_toan_hien_hanh_N_1:.2f}"
-                    )
-                    
-            except IndexError:
-                 st.warning("Thiếu chỉ tiêu 'TÀI SẢN NGẮN HẠN' hoặc 'NỢ NGẮN HẠN' để tính chỉ số.")
-                 thanh_toan_hien_hanh_N = "N/A" # Dùng để tránh lỗi ở Chức năng 5
-                 thanh_toan_hien_hanh_N_1 = "N/A"
-            
-            # --- Chức năng 5: Nhận xét AI ---
-            st.subheader("5. Nhận xét Tình hình Tài chính (AI)")
+            # Lấy Nợ ngắn hạn
+            no_ngan_han_N = no_ngan_han_row['Năm sau']
+            no_ngan_han_N_1 = no_ngan_han_row['Năm trước']
+
+            # Tăng trưởng TSNH (dùng lại ở Chức năng 5)
+            tsnh_growth = tsnh_row['Tốc độ tăng trưởng (%)']
+
+            # Tính toán
+            thanh_toan_hien_hanh_N = tsnh_n / no_ngan_han_N
+            thanh_toan_hien_hanh_N_1 = tsnh_n_1 / no_ngan_han_N_1
             
-            # Chuẩn bị dữ liệu để gửi cho AI
-            data_for_ai = pd.DataFrame({
-                'Chỉ tiêu': [
-                    'Toàn bộ Bảng phân tích (dữ liệu thô)', 
-                    'Tăng trưởng Tài sản ngắn hạn (%)', 
-                    'Thanh toán hiện hành (N-1)', 
-                    'Thanh toán hiện hành (N)'
-                ],
-                'Giá trị': [
-                    df_processed.to_markdown(index=False),
-                    f"{df_processed[df_processed['Chỉ tiêu'].str.contains('TÀI SẢN NGẮN HẠN', case=False, na=False)]['Tốc độ tăng trưởng (%)'].iloc[0]:.2f}%", 
-                    f"{thanh_toan_hien_hanh_N_1}", 
-                    f"{thanh_toan_hien_hanh_N}"
-                ]
-            }).to_markdown(index=False) 
-
-            if st.button("Yêu cầu AI Phân tích"):
-                api_key = st.secrets.get("GEMINI_API_KEY") 
+            col1, col2 = st.columns(2)
+            with col1:
+                st.metric(
+                    label="Chỉ số Thanh toán Hiện hành (Năm trước)",
+                    value=f"{thanh_toan_hien_hanh_N_1:.2f} lần"
+                )
+            with col2:
+                st.metric(
+                    label="Chỉ số Thanh toán Hiện hành (Năm sau)",
+                    value=f"{thanh_toan_hien_hanh_N:.2f} lần",
+                    delta=f"{thanh_toan_hien_hanh_N - thanh_toan_hien_hanh_N_1:.2f}"
+                )
                 
-                if api_key:
-                    with st.spinner('Đang gửi dữ liệu và chờ Gemini phân tích...'):
-                        ai_result = get_ai_analysis(data_for_ai, api_key)
-                        st.markdown("**Kết quả Phân tích từ Gemini AI:**")
-                        st.info(ai_result)
+        except KeyError:
+             st.warning("Thiếu chỉ tiêu 'TÀI SẢN NGẮN HẠN' hoặc 'NỢ NGẮN HẠN' để tính chỉ số.")
+             thanh_toan_hien_hanh_N = "N/A" # Dùng để tránh lỗi ở Chức năng 5
+             thanh_toan_hien_hanh_N_1 = "N/A"
+             tsnh_growth = None
+        
+        # --- Chức năng 5: Nhận xét AI ---
+        st.subheader("5. Nhận xét Tình hình Tài chính (AI)")
+        
+        if st.button("Yêu cầu AI Phân tích"):
+            api_key = st.secrets.get("GEMINI_API_KEY") 
+            
+            if api_key:
+                # Chỉ chuẩn bị dữ liệu gửi cho AI khi người dùng yêu cầu
+                data_for_ai = build_ai_payload(
+                    file_bytes, thanh_toan_hien_hanh_N_1, thanh_toan_hien_hanh_N, tsnh_growth
+                )
+                st.markdown("**Kết quả Phân tích từ Gemini AI:**")
+                # Dữ liệu không đổi thì dùng lại kết quả cũ, không gọi lại API
+                cached_result = st.session_state.get("ai_analysis_cache", {}).get(data_for_ai)
+                if cached_result is not None:
+                    st.markdown(cached_result)
                 else:
-                     st.error("Lỗi: Không tìm thấy Khóa API. Vui lòng cấu hình Khóa 'GEMINI_API_KEY' trong Streamlit Secrets.")
-
-    except ValueError as ve:
-        st.error(f"Lỗi cấu trúc dữ liệu: {ve}")
-    except Exception as e:
-        st.error(f"Có lỗi xảy ra khi đọc hoặc xử lý file: {e}. Vui lòng kiểm tra định dạng file.")
+                    st.write_stream(get_ai_analysis(data_for_ai, api_key))
+            else:
+                 st.error("Lỗi: Không tìm thấy Khóa API. Vui lòng cấu hình Khóa 'GEMINI_API_KEY' trong Streamlit Secrets.")
 
 else:
     st.info("Vui lòng tải lên file Excel để bắt đầu phân tích.")
@@ -195,20 +292,8 @@ if not API_KEY:
     st.error("Lỗi: Không tìm thấy Khóa API 'GEMINI_API_KEY'. Chatbot không thể hoạt động.")
 else:
     try:
-        # 2. Khởi tạo Gemini Client và Chat Session (chỉ 1 lần)
-        if "gemini_client" not in st.session_state:
-            st.session_state.gemini_client = genai.Client(api_key=API_KEY)
-            
-        if "chat_session" not in st.session_state:
-            # Thiết lập persona cho Chat Session để duy trì phong cách trả lời
-            system_instruction = "Bạn là một trợ lý phân tích tài chính thân thiện và chuyên nghiệp. Bạn có thể trả lời các câu hỏi về đầu tư, thị trường, và các chỉ số tài chính. Hãy trả lời một cách rõ ràng, ngắn gọn và sử dụng tiếng Việt."
-            
-            st.session_state.chat_session = st.session_state.gemini_client.chats.create(
-                model="gemini-2.5-flash", 
-                system_instruction=system_instruction
-            )
-            # Tin nhắn chào mừng ban đầu
-            st.session_state.messages = [{"role": "assistant", "content": "Xin chào! Tôi là trợ lý phân tích tài chính của bạn. Hãy hỏi tôi về các chỉ số, thị trường, hoặc chiến lược đầu tư!"}]
+        # 2. Dùng chung Gemini Client đã cache, Chat Session riêng cho mỗi phiên (chỉ 1 lần)
+        chat_session = get_chat_session(API_KEY)
 
         # 3. Hiển thị lịch sử chat
         for message in st.session_state.messages:
@@ -223,19 +308,19 @@ else:
             with st.chat_message("user"):
                 st.markdown(prompt)
 
-            # Gửi tin nhắn đến Gemini và nhận phản hồi
-            with st.spinner("Gemini đang soạn thảo câu trả lời..."):
-                try:
-                    response = st.session_state.chat_session.send_message(prompt)
-                    # Thêm phản hồi của AI vào lịch sử
-                    ai_response = response.text
-                    st.session_state.messages.append({"role": "assistant", "content": ai_response})
-                    with st.chat_message("assistant"):
-                        st.markdown(ai_response)
-                except APIError as e:
-                    error_msg = f"Lỗi gọi Gemini API trong Chatbot: Vui lòng kiểm tra Khóa API hoặc giới hạn sử dụng. Chi tiết lỗi: {e}"
-                    st.session_state.messages.append({"role": "assistant", "content": error_msg})
-                    st.error(error_msg)
+            # Gửi tin nhắn đến Gemini và hiển thị phản hồi dạng stream.
+            # Dùng stream đồng bộ thay vì client.aio: script Streamlit chạy đồng bộ, mỗi rerun
+            # phải tạo event loop mới, trong khi client async đã cache gắn với loop cũ.
+            try:
+                stream = chat_session.send_message_stream(prompt)
+                with st.chat_message("assistant"):
+                    ai_response = st.write_stream(chunk.text for chunk in stream if chunk.text)
+                # Thêm phản hồi của AI vào lịch sử sau khi stream kết thúc
+                st.session_state.messages.append({"role": "assistant", "content": ai_response})
+            except APIError as e:
+                error_msg = f"Lỗi gọi Gemini API trong Chatbot: Vui lòng kiểm tra Khóa API hoặc giới hạn sử dụng. Chi tiết lỗi: {e}"
+                st.session_state.messages.append({"role": "assistant", "content": error_msg})
+                st.error(error_msg)
                 
     except Exception as e:
         st.error(f"Đã xảy ra lỗi không xác định khi khởi tạo Chatbot: {e}")